@@ -5,6 +5,7 @@ import torch
 import numpy
 import os
 import torchvision
+from mosaic import make_mosaic
 from sklearn.metrics import roc_curve, auc
 
 
@@ -141,20 +142,13 @@ def plot_abnormal_normal_chart(abnormal, normal,
 
 
 def mnist_get_visualize_data(input_image, output_image):
-    pic_total_1 = numpy.array(input_image[0])
-    for i in range(input_image.shape[0] - 1):
-        pic_total_1 = numpy.concatenate((pic_total_1, input_image[i + 1]), axis=1)
-
-    pic_total_2 = numpy.array(output_image[0])
-    for i in range(output_image.shape[0] - 1):
-        pic_total_2 = numpy.concatenate((pic_total_2, output_image[i + 1]), axis=1)
-    pic_total = numpy.concatenate((pic_total_1, pic_total_2), axis=0)
-    return pic_total
+    # inputs along the top row, their reconstructions right below
+    return make_mosaic(input_image, output_image, n_columns=input_image.shape[0])
 
 
 def draw_roc(tp_list, fp_list, title=None):
     # auc drawing
-    auc_curve = auc(fp_list, tp_list)
+    auc_curve = roc_auc(fp_list, tp_list)
 
     plt.plot(fp_list, tp_list, color='red', label='AUC area:(%0.5f)' % auc_curve)
     plt.plot([0, 1], [0, 1], linestyle='--')
@@ -169,6 +163,121 @@ def draw_roc(tp_list, fp_list, title=None):
     plt.show()
 
 
+def roc_auc(fp_list, tp_list):
+    """Area under a curve by the trapezoidal rule, same result as sklearn.metrics.auc
+        :param fp_list has to be monotonic, either increasing or decreasing
+    """
+    x = numpy.asarray(fp_list, dtype=numpy.float64)
+    y = numpy.asarray(tp_list, dtype=numpy.float64)
+    if x.shape[0] < 2:
+        raise ValueError('at least 2 points are needed to compute the area under a curve, got {}'.format(x.shape[0]))
+    dx = numpy.diff(x)
+    direction = 1
+    if (dx < 0).any():
+        if not (dx <= 0).all():
+            raise ValueError('fp_list is neither increasing nor decreasing')
+        direction = -1
+    return direction * float(numpy.sum(dx * (y[1:] + y[:-1])) / 2)
+
+
+def _cumulative_counts(scores, positive, weights=None):
+    # sort once by descending score and keep the last index of every run of equal scores,
+    # so tied samples enter the curve together instead of in arbitrary order
+    scores = numpy.asarray(scores, dtype=numpy.float64).ravel()
+    positive = numpy.asarray(positive, dtype=bool).ravel()
+    if weights is None:
+        weights = numpy.ones_like(scores)
+    else:
+        weights = numpy.asarray(weights, dtype=numpy.float64).ravel()
+
+    order = numpy.argsort(scores, kind='mergesort')[::-1]
+    scores = scores[order]
+    positive = positive[order]
+    weights = weights[order]
+
+    distinct = numpy.flatnonzero(numpy.diff(scores))
+    ends = numpy.concatenate((distinct, [scores.size - 1]))
+    tps = numpy.cumsum(weights * positive)[ends]
+    fps = numpy.cumsum(weights * ~positive)[ends]
+    return tps, fps, scores[ends]
+
+
+def roc_curve_from_scores(scores, positive, weights=None):
+    """Exact ROC curve with one point per distinct score
+        :param scores are anomaly scores, higher means more likely positive
+        :param positive is a boolean mask of the positive (abnormal) samples
+        :param weights are optional per-sample weights
+        :return fpr, tpr and the thresholds, a sample is predicted positive when score >= threshold
+    """
+    tps, fps, thresholds = _cumulative_counts(scores, positive, weights)
+    tps = numpy.concatenate(([0], tps))
+    fps = numpy.concatenate(([0], fps))
+    thresholds = numpy.concatenate(([numpy.inf], thresholds))
+    tpr = tps / tps[-1] if tps[-1] > 0 else numpy.zeros_like(tps)
+    fpr = fps / fps[-1] if fps[-1] > 0 else numpy.zeros_like(fps)
+    return fpr, tpr, thresholds
+
+
+def pr_curve_from_scores(scores, positive, weights=None):
+    """Precision/recall with one point per distinct score, same conventions as roc_curve_from_scores
+        :return precision, recall, thresholds and the average precision
+    """
+    tps, fps, thresholds = _cumulative_counts(scores, positive, weights)
+    precision = tps / numpy.maximum(tps + fps, numpy.finfo(numpy.float64).tiny)
+    recall = tps / tps[-1] if tps[-1] > 0 else numpy.zeros_like(tps)
+    average_precision = float(numpy.sum(numpy.diff(numpy.concatenate(([0], recall))) * precision))
+    return precision, recall, thresholds, average_precision
+
+
+class StreamingRoc:
+    """ROC over a fixed score histogram, for test sets too large to hold at once
+
+    Scores are binned into n_bins equal bins between low and high (values outside are clipped
+    into the end bins). Histograms built on the same bins can be merged, so shards can be scored
+    separately and combined. The curve is exact up to the bin width.
+    """
+
+    def __init__(self, low, high, n_bins=10000):
+        self.edges = numpy.linspace(low, high, n_bins + 1)
+        self.positive_counts = numpy.zeros(n_bins, dtype=numpy.float64)
+        self.negative_counts = numpy.zeros(n_bins, dtype=numpy.float64)
+
+    def update(self, scores, positive, weights=None):
+        scores = numpy.asarray(scores, dtype=numpy.float64).ravel()
+        positive = numpy.asarray(positive, dtype=bool).ravel()
+        if weights is None:
+            weights = numpy.ones_like(scores)
+        else:
+            weights = numpy.asarray(weights, dtype=numpy.float64).ravel()
+        bins = numpy.clip(numpy.searchsorted(self.edges, scores, side='right') - 1,
+                          0, self.positive_counts.size - 1)
+        self.positive_counts += numpy.bincount(bins[positive], weights[positive],
+                                               minlength=self.positive_counts.size)
+        self.negative_counts += numpy.bincount(bins[~positive], weights[~positive],
+                                               minlength=self.negative_counts.size)
+        return self
+
+    def merge(self, other):
+        if not numpy.array_equal(self.edges, other.edges):
+            raise ValueError('can only merge histograms built on the same bins')
+        self.positive_counts += other.positive_counts
+        self.negative_counts += other.negative_counts
+        return self
+
+    def roc_curve(self):
+        """fpr, tpr and thresholds, thresholds are the lower bin edges from the top bin down"""
+        tps = numpy.concatenate(([0], numpy.cumsum(self.positive_counts[::-1])))
+        fps = numpy.concatenate(([0], numpy.cumsum(self.negative_counts[::-1])))
+        thresholds = numpy.concatenate(([numpy.inf], self.edges[-2::-1]))
+        tpr = tps / tps[-1] if tps[-1] > 0 else numpy.zeros_like(tps)
+        fpr = fps / fps[-1] if fps[-1] > 0 else numpy.zeros_like(fps)
+        return fpr, tpr, thresholds
+
+    def auc(self):
+        fpr, tpr, _ = self.roc_curve()
+        return roc_auc(fpr, tpr)
+
+
 def tmp():
     tp_list_19 = [0.0, 0.0, 0.0, 0.0, 0.045454545454545456, 0.045454545454545456, 0.09090909090909091, 0.09090909090909091, 0.13636363636363635, 0.18181818181818182, 0.3181818181818182, 0.36363636363636365, 0.36363636363636365, 0.4090909090909091, 0.45454545454545453, 0.5909090909090909, 0.6818181818181818, 0.7272727272727273, 0.7272727272727273, 0.7727272727272727, 0.9090909090909091, 0.9090909090909091, 0.9090909090909091, 0.9090909090909091, 0.9090909090909091, 0.9090909090909091, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 0.9545454545454546, 1.0, 1.0, 1.0]
 
@@ -1,19 +1,92 @@
 import os
+import time
+import queue
+import threading
+import traceback
 import numpy as np
 import torchvision.utils as vutils
 from tensorboardX import SummaryWriter
 from IPython import display
 from matplotlib import pyplot as plt
 import torch
+from mosaic import make_mosaic
+from check_point_store import CheckPointStore
 
 '''
     TensorBoard Data will be stored in './runs' path
+
+    With background=True, TensorBoard writes, grid rendering and PNG encoding run on a
+    worker thread fed by a bounded queue; when the queue is full a job is either dropped
+    (counted in Recorder.dropped) or the caller blocks, depending on block_when_full.
+    interactive=False skips matplotlib and IPython and writes the grids with save_image.
+
+    accumulate() keeps running loss statistics on the training device and only copies them
+    to the host every flush_steps steps or flush_secs seconds, printing at most one status
+    line every status_secs seconds.
 '''
 
 
+class MetricAccumulator:
+    """Running sum, min, max and count of scalar tensors, kept on the tensors' device
+
+    Plain numbers are put on the device of the first tensor seen, so a dict mixing a device
+    loss with a python learning rate still goes to the host in one transfer. Statistics are
+    kept in at least float32, fp16 losses summed over many steps would lose precision.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.steps = 0
+        self.device = None
+
+    def update(self, name, value):
+        if isinstance(value, torch.Tensor):
+            if self.device is None:
+                self.device = value.device
+        else:
+            value = torch.tensor(float(value), device=self.device)
+        value = value.detach().reshape(())
+        if value.dtype != torch.float64:
+            value = value.float()
+        if name not in self.metrics:
+            self.metrics[name] = [value.clone(), value.clone(), value.clone(), 1]
+            return
+        metric = self.metrics[name]
+        value = value.to(metric[0].device)
+        metric[0] += value
+        torch.minimum(metric[1], value, out=metric[1])
+        torch.maximum(metric[2], value, out=metric[2])
+        metric[3] += 1
+
+    def summary(self):
+        """Copy the metrics to the host, one transfer per device, and reset the accumulator
+            :return dict of name -> dict with mean, min, max and count
+        """
+        if not self.metrics:
+            return {}
+        by_device = {}
+        for name, metric in self.metrics.items():
+            by_device.setdefault(metric[0].device, []).append(name)
+        values = {}
+        for names in by_device.values():
+            stacked = torch.stack([torch.stack(self.metrics[name][:3]).double() for name in names])
+            values.update(zip(names, stacked.cpu().tolist()))
+        result = {}
+        for name, metric in self.metrics.items():
+            total, minimum, maximum = values[name]
+            count = metric[3]
+            result[name] = {'mean': total / count, 'min': minimum, 'max': maximum, 'count': count}
+        self.metrics = {}
+        self.steps = 0
+        return result
+
+
 class Recorder:
 
-    def __init__(self, model_name, data_name):
+    def __init__(self, model_name, data_name, background=False, queue_size=64,
+                 block_when_full=False, interactive=None,
+                 flush_steps=100, flush_secs=30.0, status_secs=10.0,
+                 keep_last=3, keep_best=3, higher_is_better=False):
         self.data_name = data_name
         self.comment = '{}_{}'.format(model_name, data_name)
         self.data_subdir = data_name
@@ -22,26 +95,110 @@ class Recorder:
         Recorder.make_dir(self.data_subdir)
         Recorder.make_dir(self.image_subdir)
         Recorder.make_dir(self.check_point_store)
+        self.check_points = CheckPointStore(self.check_point_store, keep_last=keep_last, keep_best=keep_best,
+                                            higher_is_better=higher_is_better)
 
         # TensorBoard
         self.writer = SummaryWriter('{}_log'.format(model_name.lower()))
 
+        # pyplot is not thread safe, so the worker renders headless unless told otherwise
+        self.interactive = not background if interactive is None else interactive
+        self.block_when_full = block_when_full
+        self.dropped = 0
+        self.queue = None
+        self.worker = None
+        if background:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.worker = threading.Thread(target=self._drain, name='RecorderWriter', daemon=True)
+            self.worker.start()
+
+        self.metrics = MetricAccumulator()
+        self.flush_steps = flush_steps
+        self.flush_secs = flush_secs
+        self.status_secs = status_secs
+        self.last_flush = time.monotonic()
+        self.last_status = None
+        self.last_position = None
+
     def record(self, loss, epoch, n_batch, num_batches, loss_name='loss'):
 
         # var_class = torch.autograd.variable.Variable
         if isinstance(loss, torch.autograd.Variable):
-            loss = loss.data.cpu().numpy()
+            loss = loss.detach()
 
         step = Recorder.step(epoch, n_batch, num_batches)
-        self.writer.add_scalar(loss_name, loss, step)
+        self.submit(self._write_scalar, loss_name, loss, step)
+
+    def _write_scalar(self, name, value, step):
+        if isinstance(value, torch.Tensor):
+            value = value.cpu().numpy()
+        self.writer.add_scalar(name, value, step)
+
+    def accumulate(self, losses, epoch, n_batch, num_batches, num_epochs=None):
+        """Add this step's losses to the on-device running statistics, flushing when due
+            :param losses is a scalar tensor or a dict of name -> scalar tensor
+        """
+        if not isinstance(losses, dict):
+            losses = {'loss': losses}
+        for name, value in losses.items():
+            self.metrics.update(name, value)
+        self.metrics.steps += 1
+        self.last_position = (epoch, n_batch, num_batches, num_epochs)
+
+        if self.metrics.steps >= self.flush_steps or time.monotonic() - self.last_flush >= self.flush_secs:
+            self.flush_metrics()
+
+    def flush_metrics(self):
+        """Write the aggregated statistics to TensorBoard and, rate limited, to the console"""
+        summary = self.metrics.summary()
+        self.last_flush = time.monotonic()
+        if not summary:
+            return
+        epoch, n_batch, num_batches, num_epochs = self.last_position
+        step = Recorder.step(epoch, n_batch, num_batches)
+        for name, values in summary.items():
+            for key in ('mean', 'min', 'max'):
+                self.submit(self.writer.add_scalar, '{}/{}'.format(name, key), values[key], step)
+
+        if self.last_status is None or self.last_flush - self.last_status >= self.status_secs:
+            self.last_status = self.last_flush
+            status = ', '.join('{}: {:.4f} [{:.4f}, {:.4f}]'.format(name, values['mean'], values['min'], values['max'])
+                               for name, values in summary.items())
+            print('Epoch: [{}/{}], Batch Num: [{}/{}], {}'.format(
+                epoch, num_epochs, n_batch, num_batches, status))
+
+    def log_profile(self, profiler, epoch):
+        """Publish a PhaseProfiler's per-phase p50/p95 and samples/sec for the epoch, then reset it"""
+        if not profiler.enabled:
+            return
+        phases, samples_per_sec = profiler.summary()
+        for name, values in phases.items():
+            for key in ('p50_ms', 'p95_ms', 'mean_ms'):
+                self.submit(self.writer.add_scalar, 'profile/{}/{}'.format(name, key), values[key], epoch)
+        if profiler.samples:
+            self.submit(self.writer.add_scalar, 'profile/samples_per_sec', samples_per_sec, epoch)
+        profiler.reset()
 
     def log_images(self, images, num_images, epoch, n_batch, num_batches,
-                   format='NCHW', normalize=True, title=None):
+                   format='NCHW', normalize=True, title=None, reconstructions=None, max_tiles=None):
 
         """
         input images are expected in format (NCHW)
+        with reconstructions given, images and reconstructions are paired into one mosaic
+        (see mosaic.make_mosaic) of at most max_tiles pairs
         """
 
+        if reconstructions is not None:
+            step = Recorder.step(epoch, n_batch, num_batches)
+            img_name = '{}/images: *{}*'.format(self.comment, title)
+            if isinstance(images, torch.Tensor):
+                images = images.detach()
+            if isinstance(reconstructions, torch.Tensor):
+                reconstructions = reconstructions.detach()
+            self.submit(self._write_mosaic, images, reconstructions, max_tiles,
+                        num_images, epoch, n_batch, step, img_name, normalize)
+            return
+
         if type(images) == np.ndarray:
 
             if len(images.shape) == 3:
@@ -54,6 +211,14 @@ class Recorder:
 
         step = Recorder.step(epoch, n_batch, num_batches)
         img_name = '{}/images: *{}*'.format(self.comment, title)
+        self.submit(self._write_images, images.detach(), num_images, epoch, n_batch, step, img_name, normalize)
+
+    def _write_mosaic(self, images, reconstructions, max_tiles, num_images, epoch, n_batch, step, img_name, normalize):
+        pic_total = make_mosaic(images, reconstructions, max_tiles=max_tiles)
+        self._write_images(torch.from_numpy(pic_total), num_images, epoch, n_batch, step, img_name, normalize)
+
+    def _write_images(self, images, num_images, epoch, n_batch, step, img_name, normalize):
+        images = images.cpu()
 
         # Make horizontal grid from image tensor
         horizontal_grid = vutils.make_grid(images, normalize=normalize, scale_each=True)
@@ -69,6 +234,11 @@ class Recorder:
 
     def save_torch_images(self, horizontal_grid, grid, epoch, n_batch, plot_horizontal=True, axis=False):
 
+        if not self.interactive:
+            vutils.save_image(horizontal_grid, self.image_path(epoch, n_batch, comment='horizontal'))
+            vutils.save_image(grid, self.image_path(epoch, n_batch))
+            return
+
         # Plot and save horizontal
         fig = plt.figure(figsize=(16, 16))
         plt.imshow(np.moveaxis(horizontal_grid.numpy(), 0, -1))
@@ -88,8 +258,11 @@ class Recorder:
         plt.close()
 
     def save_images(self, fig, epoch, n_batch, comment=''):
-        fig.savefig(os.path.join(self.image_subdir,
-                                 '{}_epoch_{}_batch_{}.png'.format(comment, epoch, n_batch)))
+        fig.savefig(self.image_path(epoch, n_batch, comment))
+
+    def image_path(self, epoch, n_batch, comment=''):
+        return os.path.join(self.image_subdir,
+                            '{}_epoch_{}_batch_{}.png'.format(comment, epoch, n_batch))
 
     @staticmethod
     def display_status(epoch, num_epochs, n_batch, num_batches, loss):
@@ -114,11 +287,61 @@ class Recorder:
                    '{}/{}_epoch_{}'.format(out_dir, name, epoch))
         print('>> epoch_{} saving in {}'.format(epoch, out_dir))
 
+    def save_check_point(self, model, epoch, optimizer=None, scheduler=None, score=None, name='final'):
+        """Queue a resumable checkpoint, see CheckPointStore.save
+            :param score ranks the checkpoints for keep_best, lowest first (a loss) unless the Recorder
+                   was created with higher_is_better=True (e.g. an AUC)
+        """
+        self.check_points.save(epoch, model, optimizer=optimizer, scheduler=scheduler, score=score, name=name)
+        print('>> epoch_{} queued for {}'.format(epoch, self.check_point_store))
+
+    def submit(self, job, *args):
+        """Run job(*args) on the writer thread, or right away when there is none
+            :return False when the queue was full and the job was dropped
+        """
+        if self.queue is None:
+            job(*args)
+            return True
+        try:
+            self.queue.put((job, args), block=self.block_when_full)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def flush(self):
+        """Wait until every queued job has been written"""
+        if self.queue is not None:
+            self.queue.join()
+        self.writer.flush()
+
     def close(self):
+        self.flush_metrics()
+        self.check_points.close()
+        if self.worker is not None:
+            self.queue.put(None)
+            self.worker.join()
+            self.worker = None
+            self.queue = None
         self.writer.close()
 
     # Private Functionality
 
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                job, args = item
+                try:
+                    job(*args)
+                except Exception:
+                    # a failed write must not kill the worker and stall the queue
+                    traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
     @staticmethod
     def step(epoch, n_batch, num_batches):
         return epoch * num_batches + n_batch
@@ -0,0 +1,73 @@
+import numpy
+import torch
+
+'''
+    Per-sample reconstruction errors for a whole loader, computed with one
+    batched reduction per batch and a single device -> host copy at the end.
+'''
+
+REDUCTIONS = ('mse', 'l1', 'rmse', 'sse', 'max')
+
+
+def reconstruction_error(inputs, outputs, reduction='mse'):
+    """Per-sample error between two (N, D) tensors
+        :param reduction is one of mse, l1, rmse, sse (sum of squares) or max (max absolute error)
+    """
+    diff = outputs - inputs
+    if reduction == 'mse':
+        return diff.pow(2).mean(dim=1)
+    if reduction == 'l1':
+        return diff.abs().mean(dim=1)
+    if reduction == 'rmse':
+        return diff.pow(2).mean(dim=1).sqrt()
+    if reduction == 'sse':
+        return diff.pow(2).sum(dim=1)
+    if reduction == 'max':
+        return diff.abs().max(dim=1)[0]
+    raise ValueError('unknown reduction {}, expected one of {}'.format(reduction, REDUCTIONS))
+
+
+def score_model(model, data_loader, device=torch.device('cpu'), reductions=('mse',)):
+    """Score every sample of data_loader by how well model reconstructs it
+        :param model returns either the reconstruction or an (encoded, decoded) tuple
+        :param data_loader yields (images, labels) batches
+        :param reductions names the errors to compute, see reconstruction_error
+        :return dict of reduction name -> float32 numpy array, and the int64 label array
+    """
+    total = len(data_loader.dataset)
+    scores = {name: torch.empty(total, dtype=torch.float32, device=device) for name in reductions}
+    labels = torch.empty(total, dtype=torch.int64, device=device)
+
+    # frozen TorchScript modules have no training flag and are always in eval mode
+    was_training = getattr(model, 'training', False)
+    if was_training:
+        model.eval()
+    count = 0
+    with torch.no_grad():
+        for images, label in data_loader:
+            current_images = images.view(images.size(0), -1).to(device, non_blocking=True)
+            decoded_data = model(current_images)
+            if isinstance(decoded_data, tuple):
+                decoded_data = decoded_data[-1]
+            n = current_images.size(0)
+            for name in reductions:
+                scores[name][count:count + n] = reconstruction_error(current_images, decoded_data, name)
+            labels[count:count + n] = torch.as_tensor(label).to(device, non_blocking=True)
+            count += n
+    if was_training:
+        model.train()
+
+    # drop_last loaders leave the tail of the buffers unused
+    scores = {name: value[:count].cpu().numpy() for name, value in scores.items()}
+    return scores, labels[:count].cpu().numpy()
+
+
+def normal_mask(labels, normal_number=0):
+    """Boolean mask of the samples whose label is the normal class"""
+    return numpy.asarray(labels) == normal_number
+
+
+def split_scores(scores, labels, normal_number=0):
+    """Split a score array into (normal_scores, abnormal_scores)"""
+    mask = normal_mask(labels, normal_number)
+    return scores[mask], scores[~mask]
@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import numpy
+import torch
+import torch.utils.data
+from PIL import Image
+import Helper
+from Recorder import Recorder
+from anomaly_scoring import score_model
+from twod_my_data_loader import MyDataLoader, batch_data_loader, img_transform
+from ae_model import AutoEncoder
+
+'''
+    Speed of the hot paths on synthetic MNIST shaped PNGs, so it runs offline.
+
+    python benchmark.py --out results.json
+    python benchmark.py --baseline results.json --tolerance 0.2
+
+    Every result is {"value": ..., "unit": ...}; units ending in '/s' are throughputs where
+    higher is better, 's' are durations where lower is better. Each value is the best of
+    several runs, the least disturbed by other load on the machine. With --baseline the run
+    exits with status 1 when any result is worse than the baseline by more than the tolerance;
+    durations also have to be slower by more than --noise-floor seconds, so timer jitter on
+    sub-millisecond results does not fail the gate.
+'''
+
+
+def make_fixtures(directory, count, seed=0):
+    """Write count random 28x28 grayscale PNGs named '<label>_<index>.png'"""
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    rng = numpy.random.RandomState(seed)
+    images = rng.randint(0, 256, size=(count, 28, 28)).astype(numpy.uint8)
+    for index in range(count):
+        Image.fromarray(images[index]).save(os.path.join(directory, '{}_{}.png'.format(index % 10, index)))
+
+
+def measure(func, repeat=9):
+    """Best wall time of func over repeat runs, after one warm up run"""
+    func()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def throughput(count, seconds):
+    return {'value': count / seconds, 'unit': 'samples/s'}
+
+
+def bench_loader(results, fixtures, cache_dir, batch_size=128):
+    raw = MyDataLoader(path=fixtures, transform=img_transform)
+    cached = MyDataLoader(path=fixtures, transform=img_transform, cache_dir=cache_dir)
+    raw_loader = torch.utils.data.DataLoader(dataset=raw, batch_size=batch_size, shuffle=True)
+    cached_loader = torch.utils.data.DataLoader(dataset=cached, batch_size=batch_size, shuffle=True)
+    batch_loader = batch_data_loader(cached, batch_size, shuffle=True)
+
+    def drain(data_loader):
+        return lambda: [None for _ in data_loader]
+    results['loader/raw_png'] = throughput(len(raw), measure(drain(raw_loader)))
+    results['loader/cached'] = throughput(len(cached), measure(drain(cached_loader)))
+    results['loader/cached_batched'] = throughput(len(cached), measure(drain(batch_loader)))
+
+
+def bench_model(results, batch_sizes, thread_counts, steps=10):
+    original_threads = torch.get_num_threads()
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        for batch_size in batch_sizes:
+            model = AutoEncoder()
+            criterion = torch.nn.MSELoss()
+            optimizer = torch.optim.Adam(model.parameters(), lr=1e-3, weight_decay=1e-5)
+            images = torch.rand(batch_size, 28 * 28) * 2 - 1
+
+            def train():
+                for _ in range(steps):
+                    _, d_output = model(images)
+                    loss = criterion(d_output, images)
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+
+            def infer():
+                with torch.no_grad():
+                    for _ in range(steps):
+                        model(images)
+
+            key = 'batch_{}/threads_{}'.format(batch_size, threads)
+            results['train_step/' + key] = throughput(batch_size * steps, measure(train))
+            model.eval()
+            results['inference/' + key] = throughput(batch_size * steps, measure(infer))
+    torch.set_num_threads(original_threads)
+
+
+def bench_scoring(results, count, batch_size=128):
+    model = AutoEncoder()
+    data_set = torch.utils.data.TensorDataset(torch.rand(count, 28 * 28) * 2 - 1,
+                                              torch.arange(count) % 10)
+    data_loader = torch.utils.data.DataLoader(data_set, batch_size=batch_size)
+    results['scoring/mse'] = throughput(count, measure(lambda: score_model(model, data_loader)))
+
+
+def bench_roc(results, sizes):
+    rng = numpy.random.RandomState(0)
+    for size in sizes:
+        positive = rng.rand(size) < 0.1
+        scores = rng.rand(size) + positive
+        results['roc/{}'.format(size)] = {
+            'value': measure(lambda: Helper.roc_auc(*Helper.roc_curve_from_scores(scores, positive)[:2])),
+            'unit': 's'}
+
+
+def bench_visualize(results, tiles=128):
+    rng = numpy.random.RandomState(0)
+    input_image = rng.rand(tiles, 28, 28).astype(numpy.float32)
+    output_image = rng.rand(tiles, 28, 28).astype(numpy.float32)
+    results['visualize/{}_tiles'.format(tiles)] = {
+        'value': measure(lambda: Helper.mnist_get_visualize_data(input_image, output_image)),
+        'unit': 's'}
+
+
+def bench_recorder(results, steps=1000):
+    loss = torch.tensor(0.5)
+    images = torch.rand(16, 1, 28, 28)
+    # a background recorder that drops jobs when its queue is full would time work it never did
+    for name, options in (('sync', {}), ('background', {'background': True, 'block_when_full': True})):
+        recorder = Recorder('benchmark', 'BENCH_{}'.format(name.upper()), interactive=False, **options)
+
+        def record():
+            for step in range(steps):
+                recorder.record(loss, 0, step, steps)
+
+        def accumulate():
+            for step in range(steps):
+                recorder.accumulate(loss, 0, step, steps)
+
+        # per step costs are microseconds, as throughputs they are compared relative to the baseline
+        results['recorder/{}/record'.format(name)] = {'value': steps / measure(record), 'unit': 'steps/s'}
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results['recorder/{}/accumulate'.format(name)] = {'value': steps / measure(accumulate),
+                                                              'unit': 'steps/s'}
+        results['recorder/{}/log_images'.format(name)] = {
+            'value': measure(lambda: recorder.log_images(images, 16, 0, 0, 1, reconstructions=images)),
+            'unit': 's'}
+        recorder.close()
+        if recorder.dropped:
+            raise RuntimeError('{} recorder dropped {} jobs'.format(name, recorder.dropped))
+
+
+def compare(results, baseline, tolerance, noise_floor=1e-4):
+    """Names of the results that are worse than baseline by more than tolerance
+        :param noise_floor is the smallest slowdown in seconds a duration has to show to count
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline or baseline[name]['unit'] != result['unit']:
+            continue
+        value = result['value']
+        reference = baseline[name]['value']
+        if result['unit'].endswith('/s'):
+            worse = value < reference * (1 - tolerance)
+        else:
+            worse = value > reference * (1 + tolerance) and value - reference > noise_floor
+        if worse:
+            regressions.append(name)
+            print('REGRESSION {}: {:.6g} {} vs baseline {:.6g}'.format(name, value, result['unit'], reference))
+    return regressions
+
+
+def run(quick=False):
+    results = {}
+    batch_sizes = [32, 128] if quick else [32, 128, 512]
+    thread_counts = sorted({1, torch.get_num_threads()})
+    roc_sizes = [10000, 100000] if quick else [10000, 100000, 1000000]
+    fixture_count = 512 if quick else 4096
+
+    current_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='ae_benchmark_') as work_dir:
+        # Recorder writes its logs and images relative to the working directory
+        os.chdir(work_dir)
+        try:
+            make_fixtures('fixtures', fixture_count)
+            bench_loader(results, 'fixtures', 'cache')
+            bench_model(results, batch_sizes, thread_counts)
+            bench_scoring(results, fixture_count)
+            bench_roc(results, roc_sizes)
+            bench_visualize(results)
+            bench_recorder(results)
+        finally:
+            os.chdir(current_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AutoEncoder hot paths')
+    parser.add_argument('--out', default=None, help='write the results as JSON')
+    parser.add_argument('--baseline', default=None, help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--noise-floor', type=float, default=1e-4,
+                        help='seconds a duration has to get slower by before it counts as a regression')
+    parser.add_argument('--quick', action='store_true')
+    args = parser.parse_args()
+
+    results = run(quick=args.quick)
+    for name, result in sorted(results.items()):
+        print('{:<45} {:>14.6g} {}'.format(name, result['value'], result['unit']))
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance, args.noise_floor):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import os
+import re
+import json
+import queue
+import random
+import threading
+import traceback
+import numpy
+import torch
+
+'''
+    Checkpoints hold model, optimizer and scheduler state plus the RNG state, so a run can
+    resume where it stopped. save() snapshots everything to CPU memory on the calling thread
+    and a writer thread does torch.save into a temp file that is renamed into place.
+    index.json lists the finished checkpoints; only the last keep_last epochs and the
+    keep_best best scored ones are kept on disk.
+'''
+
+INDEX_FILE = 'index.json'
+LEGACY_PATTERN = re.compile(r'^(.+)_epoch_(\d+)$')
+
+
+class CheckPointStore:
+
+    def __init__(self, directory, keep_last=3, keep_best=3, higher_is_better=False, background=True):
+        """
+            :param directory is usually Recorder.check_point_store
+            :param higher_is_better picks the direction of the validation score, the default suits losses
+        """
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.higher_is_better = higher_is_better
+        self.background = background
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.lock = threading.Lock()
+        self.entries = []
+        index_path = os.path.join(directory, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.entries = json.load(f)
+
+        # one snapshot waiting at most, so host memory holds no more than two copies of the state
+        self.queue = queue.Queue(maxsize=1)
+        self.worker = None
+
+    def save(self, epoch, model, optimizer=None, scheduler=None, score=None, name='final'):
+        """Snapshot the training state and write it in the background
+            :param score is the validation score used to rank the best checkpoints
+        """
+        # numpy and tensor scalars are not JSON serializable, index.json needs plain numbers
+        epoch = int(epoch)
+        if score is not None:
+            score = float(score)
+        state = {'epoch': epoch,
+                 'score': score,
+                 'model': CheckPointStore.snapshot(model.state_dict()),
+                 'optimizer': CheckPointStore.snapshot(optimizer.state_dict()) if optimizer is not None else None,
+                 'scheduler': CheckPointStore.snapshot(scheduler.state_dict()) if scheduler is not None else None,
+                 'rng': CheckPointStore.rng_state()}
+        entry = {'epoch': epoch, 'score': score, 'file': '{}_epoch_{}.pt'.format(name, epoch)}
+
+        if not self.background:
+            self._write(entry, state)
+            return
+        if self.worker is None:
+            self.worker = threading.Thread(target=self._drain, name='CheckPointWriter', daemon=True)
+            self.worker.start()
+        self.queue.put((entry, state))
+
+    def latest(self):
+        """Path of the most recent checkpoint, falling back to plain '<name>_epoch_<n>' state dicts"""
+        with self.lock:
+            entries = list(self.entries)
+        if entries:
+            return os.path.join(self.directory, max(entries, key=lambda e: e['epoch'])['file'])
+
+        legacy = []
+        for file_name in os.listdir(self.directory):
+            match = LEGACY_PATTERN.match(file_name)
+            if match is not None:
+                legacy.append((int(match.group(2)), file_name))
+        if legacy:
+            return os.path.join(self.directory, max(legacy)[1])
+        return None
+
+    def best(self):
+        """Path of the best scored checkpoint, None when no checkpoint has a score"""
+        with self.lock:
+            scored = [e for e in self.entries if e['score'] is not None]
+        if not scored:
+            return None
+        return os.path.join(self.directory, self._rank(scored)[0]['file'])
+
+    def wait(self):
+        """Block until every pending checkpoint is on disk"""
+        if self.worker is not None:
+            self.queue.join()
+
+    def close(self):
+        if self.worker is not None:
+            self.queue.put(None)
+            self.worker.join()
+            self.worker = None
+
+    @staticmethod
+    def load(path, model, optimizer=None, scheduler=None, restore_rng=False, map_location='cpu'):
+        """Restore a checkpoint written by save() or a plain state dict from Recorder.save_models
+            :return the stored epoch, None for a plain state dict
+        """
+        state = torch.load(path, map_location=map_location, weights_only=False)
+        if 'model' not in state or 'rng' not in state:
+            model.load_state_dict(state)
+            return None
+
+        model.load_state_dict(state['model'])
+        if optimizer is not None and state['optimizer'] is not None:
+            optimizer.load_state_dict(state['optimizer'])
+        if scheduler is not None and state['scheduler'] is not None:
+            scheduler.load_state_dict(state['scheduler'])
+        if restore_rng:
+            CheckPointStore.set_rng_state(state['rng'])
+        return state['epoch']
+
+    @staticmethod
+    def snapshot(value):
+        # copy=True so the optimizer updating CPU tensors in place cannot change the snapshot
+        if isinstance(value, torch.Tensor):
+            return value.detach().to('cpu', copy=True)
+        if isinstance(value, dict):
+            return {key: CheckPointStore.snapshot(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(CheckPointStore.snapshot(item) for item in value)
+        return value
+
+    @staticmethod
+    def rng_state():
+        return {'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                'numpy': numpy.random.get_state(),
+                'python': random.getstate()}
+
+    @staticmethod
+    def set_rng_state(state):
+        torch.set_rng_state(state['torch'])
+        if state['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state['cuda'])
+        numpy.random.set_state(state['numpy'])
+        random.setstate(state['python'])
+
+    # Private Functionality
+
+    def _drain(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                try:
+                    self._write(*item)
+                except Exception:
+                    traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def _write(self, entry, state):
+        path = os.path.join(self.directory, entry['file'])
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+        with self.lock:
+            entries = [e for e in self.entries if e['file'] != entry['file']] + [entry]
+            keep = sorted(entries, key=lambda e: e['epoch'])[-self.keep_last:] if self.keep_last > 0 else []
+            scored = [e for e in entries if e['score'] is not None]
+            keep += self._rank(scored)[:self.keep_best]
+            kept_files = set(e['file'] for e in keep)
+            removed = [e for e in entries if e['file'] not in kept_files]
+            entries = [e for e in entries if e['file'] in kept_files]
+
+            # the in-memory list only changes once index.json on disk agrees with it
+            index_path = os.path.join(self.directory, INDEX_FILE)
+            try:
+                with open(index_path + '.tmp', 'w') as f:
+                    json.dump(entries, f)
+                os.replace(index_path + '.tmp', index_path)
+            finally:
+                if os.path.exists(index_path + '.tmp'):
+                    os.remove(index_path + '.tmp')
+            self.entries = entries
+
+        for e in removed:
+            old_path = os.path.join(self.directory, e['file'])
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def _rank(self, entries):
+        return sorted(entries, key=lambda e: e['score'], reverse=self.higher_is_better)
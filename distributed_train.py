@@ -0,0 +1,250 @@
+import os
+import sys
+import socket
+import argparse
+import tempfile
+import numpy
+import torch
+import torch.distributed
+import torch.multiprocessing
+import torch.utils.data
+from PIL import Image
+from torch.nn.parallel import DistributedDataParallel
+import Helper
+from Recorder import Recorder
+from anomaly_scoring import score_model, normal_mask
+from twod_my_data_loader import MyDataLoader, batch_data_loader, img_transform
+from ae_model import AutoEncoder
+
+'''
+    Data parallel CPU training of the AutoEncoder over local processes with the gloo backend.
+    Every rank trains on its DistributedSampler shard with batch_size / world_size samples per
+    step and DistributedDataParallel averages the gradients, so a step is the same as one
+    single process step on the whole batch. Only rank 0 logs through Recorder and writes
+    checkpoints; eval scores are computed per shard and gathered on every rank.
+
+    python distributed_train.py --data ../../../public_data/mem_ae_mnist/0 --world-size 4
+    python distributed_train.py --verify --world-size 2
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawn(worker, world_size, *args):
+    """Run worker(rank, world_size, *args) in world_size local processes"""
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(free_port()))
+    torch.multiprocessing.spawn(worker, args=(world_size,) + args, nprocs=world_size, join=True)
+
+
+def setup(rank, world_size, threads_per_rank=None):
+    """Join the process group and pin the rank to its own slice of cores"""
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    if threads_per_rank is None:
+        threads_per_rank = max(1, (os.cpu_count() or 1) // world_size)
+    torch.set_num_threads(threads_per_rank)
+    if hasattr(os, 'sched_setaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+        own = cores[rank * threads_per_rank:(rank + 1) * threads_per_rank]
+        if own:
+            os.sched_setaffinity(0, own)
+
+
+def train_step(model, optimizer, criterion, img):
+    _, d_output = model(img)
+    loss = criterion(d_output, img)
+    optimizer.zero_grad()
+    loss.backward()
+    optimizer.step()
+    return loss.detach()
+
+
+def gather_scores(scores, labels, world_size):
+    """Concatenate every rank's scores and labels, shards may differ in length"""
+    size = torch.tensor([len(scores)])
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    torch.distributed.all_gather(sizes, size)
+    longest = int(max(sizes).item())
+
+    local = torch.zeros(2, longest, dtype=torch.float64)
+    local[0, :len(scores)] = torch.from_numpy(scores.astype(numpy.float64))
+    local[1, :len(labels)] = torch.from_numpy(labels.astype(numpy.float64))
+    gathered = [torch.zeros_like(local) for _ in range(world_size)]
+    torch.distributed.all_gather(gathered, local)
+    gathered = torch.cat([item[:, :int(n.item())] for item, n in zip(gathered, sizes)], dim=1)
+    return gathered[0].numpy().astype(numpy.float32), gathered[1].numpy().astype(numpy.int64)
+
+
+def make_data_loaders(rank, world_size, args, shuffle=True):
+    """Training loader over this rank's DistributedSampler shard and eval loader over its strided shard
+        :return the sampler, the training loader and the eval loader
+    """
+    if args.cache_dir and rank == 0:
+        # built once up front, ranks rebuilding the same cache concurrently would clobber it
+        for split in ('training', 'testing'):
+            MyDataLoader.build_cache(os.path.join(args.data, split), os.path.join(args.cache_dir, split))
+    torch.distributed.barrier()
+    train_data_set = MyDataLoader(path=os.path.join(args.data, 'training'), transform=img_transform,
+                                  normal_number=args.normal_number,
+                                  cache_dir=os.path.join(args.cache_dir, 'training') if args.cache_dir else None)
+    valid_data_set = MyDataLoader(path=os.path.join(args.data, 'testing'), transform=img_transform,
+                                  normal_number=args.normal_number,
+                                  cache_dir=os.path.join(args.cache_dir, 'testing') if args.cache_dir else None)
+    sampler = torch.utils.data.distributed.DistributedSampler(train_data_set, num_replicas=world_size, rank=rank,
+                                                              shuffle=shuffle, seed=args.seed, drop_last=True)
+    data_loader = batch_data_loader(train_data_set, args.batch_size // world_size, drop_last=True, sampler=sampler)
+    # a strided shard, unlike DistributedSampler it never pads with repeated samples
+    valid_shard = torch.utils.data.Subset(valid_data_set, range(rank, len(valid_data_set), world_size))
+    valid_data_loader = torch.utils.data.DataLoader(dataset=valid_shard, batch_size=args.batch_size)
+    return sampler, data_loader, valid_data_loader
+
+
+def make_model(args):
+    model = DistributedDataParallel(AutoEncoder())
+    criterion = torch.nn.MSELoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.learning_rate, weight_decay=1e-5)
+    return model, criterion, optimizer
+
+
+def evaluate(model, valid_data_loader, world_size):
+    """MSE scores and labels of the whole eval set, in rank order of the strided shards"""
+    scores, labels = score_model(model.module, valid_data_loader)
+    return gather_scores(scores['mse'], labels, world_size)
+
+
+def train_worker(rank, world_size, args):
+    setup(rank, world_size, args.threads_per_rank)
+    torch.manual_seed(args.seed)
+    sampler, data_loader, valid_data_loader = make_data_loaders(rank, world_size, args)
+    model, criterion, optimizer = make_model(args)
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=10, gamma=0.9)
+    recorder = Recorder('distributed_auto_encoder', 'AE_MNIST', interactive=False) if rank == 0 else None
+
+    for epoch in range(args.epochs):
+        model.train()
+        sampler.set_epoch(epoch)
+        for index, (img, _) in enumerate(data_loader):
+            img = img.view(img.size(0), -1)
+            loss = train_step(model, optimizer, criterion, img)
+            if recorder is not None:
+                recorder.accumulate(loss, epoch, index, len(data_loader), num_epochs=args.epochs)
+        lr_scheduler.step()
+
+        if epoch % args.eval_every == 0 or epoch == args.epochs - 1:
+            scores, labels = evaluate(model, valid_data_loader, world_size)
+            if recorder is not None:
+                normal = normal_mask(labels, args.normal_number)
+                fpr, tpr, _ = Helper.roc_curve_from_scores(scores, ~normal)
+                valid_loss = float(scores[normal].mean()) if normal.any() else float(scores.mean())
+                recorder.submit(recorder.writer.add_scalar, 'eval/auc', Helper.roc_auc(fpr, tpr), epoch)
+                recorder.submit(recorder.writer.add_scalar, 'eval/normal_mse', valid_loss, epoch)
+                recorder.save_check_point(model.module, epoch, optimizer, lr_scheduler, score=valid_loss)
+
+    if recorder is not None:
+        recorder.close()
+    torch.distributed.destroy_process_group()
+
+
+# Verification: the training and eval path of train_worker on synthetic images, run with
+# world_size ranks and with a single rank. Without shuffling, step i of every rank together
+# covers rows i * batch_size to (i + 1) * batch_size, the same batch the single rank takes.
+
+def write_verify_images(directory, count, seed=0):
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    rng = numpy.random.RandomState(seed)
+    images = rng.randint(0, 256, size=(count, 28, 28)).astype(numpy.uint8)
+    for index in range(count):
+        Image.fromarray(images[index]).save(os.path.join(directory, '{}_{}.png'.format(index % 10, index)))
+
+
+def verify_worker(rank, world_size, args, steps, out_path):
+    setup(rank, world_size, threads_per_rank=1)
+    torch.manual_seed(args.seed)
+    _, data_loader, valid_data_loader = make_data_loaders(rank, world_size, args, shuffle=False)
+    model, criterion, optimizer = make_model(args)
+    model.train()
+    for index, (img, _) in enumerate(data_loader):
+        if index == steps:
+            break
+        train_step(model, optimizer, criterion, img.view(img.size(0), -1))
+    scores, labels = evaluate(model, valid_data_loader, world_size)
+    if rank == 0:
+        torch.save({'model': model.module.state_dict(), 'scores': scores, 'labels': labels}, out_path)
+    torch.distributed.destroy_process_group()
+
+
+def verify(world_size, batch_size=64, steps=5, tolerance=1e-5):
+    """Train steps and score the eval set distributed and in a single process on the same data
+        :return the largest absolute parameter and eval score differences, raises when above tolerance
+    """
+    if batch_size % world_size:
+        raise ValueError('batch_size {} is not a multiple of world_size {}'.format(batch_size, world_size))
+    with tempfile.TemporaryDirectory() as directory:
+        # the eval set size is not a multiple of world_size, so the shards differ in length
+        write_verify_images(os.path.join(directory, 'data', 'training'), batch_size * steps, seed=0)
+        write_verify_images(os.path.join(directory, 'data', 'testing'), 2 * batch_size + 1, seed=1)
+        args = argparse.Namespace(data=os.path.join(directory, 'data'), cache_dir=os.path.join(directory, 'cache'),
+                                  batch_size=batch_size, learning_rate=1e-3, normal_number=0, seed=0)
+        runs = {}
+        for name, size in (('distributed', world_size), ('single', 1)):
+            out_path = os.path.join(directory, '{}.pt'.format(name))
+            os.environ['MASTER_PORT'] = str(free_port())
+            spawn(verify_worker, size, args, steps, out_path)
+            runs[name] = torch.load(out_path, weights_only=False)
+
+    distributed, single = runs['distributed'], runs['single']
+    parameter_difference = max((value - distributed['model'][name]).abs().max().item()
+                               for name, value in single['model'].items())
+    # gathered scores come rank by rank, put them back in dataset order
+    count = len(single['scores'])
+    order = numpy.concatenate([numpy.arange(rank, count, world_size) for rank in range(world_size)])
+    scores = numpy.empty_like(distributed['scores'])
+    scores[order] = distributed['scores']
+    labels = numpy.empty_like(distributed['labels'])
+    labels[order] = distributed['labels']
+    if len(scores) != count or not (labels == single['labels']).all():
+        raise AssertionError('distributed eval gathered a different set of samples')
+    score_difference = float(abs(scores - single['scores']).max())
+
+    if parameter_difference > tolerance:
+        raise AssertionError('distributed and single process parameters differ by {}'.format(parameter_difference))
+    if score_difference > tolerance:
+        raise AssertionError('distributed and single process eval scores differ by {}'.format(score_difference))
+    return parameter_difference, score_difference
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Data parallel CPU training of the AutoEncoder')
+    parser.add_argument('--data', default='../../../public_data/mem_ae_mnist/0',
+                        help='directory with training and testing subdirectories')
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--world-size', type=int, default=2)
+    parser.add_argument('--threads-per-rank', type=int, default=None)
+    parser.add_argument('--epochs', type=int, default=360)
+    parser.add_argument('--batch-size', type=int, default=128, help='global batch size over all ranks')
+    parser.add_argument('--learning-rate', type=float, default=1e-3)
+    parser.add_argument('--eval-every', type=int, default=20)
+    parser.add_argument('--normal-number', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verify', action='store_true',
+                        help='check a few distributed steps against a single process run and exit')
+    args = parser.parse_args()
+
+    if args.verify:
+        print('>> max parameter difference: {:.3g}, max eval score difference: {:.3g}'.format(
+            *verify(args.world_size)))
+        return
+    if args.batch_size % args.world_size:
+        sys.exit('--batch-size has to be a multiple of --world-size')
+    if args.eval_every < 1:
+        sys.exit('--eval-every has to be at least 1')
+    spawn(train_worker, args.world_size, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import os
+import json
+import numpy
+import torch
+
+'''
+    LatentStore keeps the encoder's codes of a whole dataset in a flat memory mapped file
+    (codes.bin, float16 or float32) next to an int64 label file (labels.bin); meta.json holds
+    the row count, so new data is appended without re-encoding what is already stored.
+
+    KnnAnomalyIndex scores samples by their mean distance to the k nearest normal codes,
+    computed with blocked matrix multiplies. It is an alternative or a complement to the
+    reconstruction MSE of anomaly_scoring.
+
+    store = LatentStore('AE_MNIST/latent')
+    store.encode(model, train_data_loader)
+    index = KnnAnomalyIndex(store, k=5)
+    scores, labels = index.score_loader(model, valid_data_loader)
+'''
+
+CODES_FILE = 'codes.bin'
+LABELS_FILE = 'labels.bin'
+META_FILE = 'meta.json'
+
+
+def encode_batches(model, data_loader, device=torch.device('cpu')):
+    """Yield (codes, labels) numpy arrays per batch
+        :param model is an AutoEncoder (its encoded output is used) or an encoder only module
+    """
+    with torch.no_grad():
+        for images, label in data_loader:
+            codes = model(images.view(images.size(0), -1).to(device))
+            if isinstance(codes, tuple):
+                codes = codes[0]
+            yield codes.float().cpu().numpy(), numpy.asarray(label, dtype=numpy.int64)
+
+
+class LatentStore:
+
+    def __init__(self, directory, dim=30, dtype='float16'):
+        """
+            :param dtype is float16 or float32, ignored when directory already holds a store
+        """
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        meta_path = os.path.join(directory, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            dim, dtype, self.count = meta['dim'], meta['dtype'], meta['count']
+        else:
+            self.count = 0
+        self.dim = dim
+        self.dtype = numpy.dtype(dtype)
+
+    def append(self, codes, labels):
+        """Add rows to the end of the store"""
+        codes = numpy.ascontiguousarray(codes, dtype=self.dtype).reshape(-1, self.dim)
+        labels = numpy.ascontiguousarray(labels, dtype=numpy.int64).reshape(-1)
+        if len(codes) != len(labels):
+            raise ValueError('{} codes but {} labels'.format(len(codes), len(labels)))
+
+        # rows past count are leftovers of an interrupted append, overwrite them
+        for file_name, data, row_bytes in ((CODES_FILE, codes, self.dim * self.dtype.itemsize),
+                                           (LABELS_FILE, labels, 8)):
+            with open(os.path.join(self.directory, file_name), 'ab') as f:
+                f.truncate(self.count * row_bytes)
+                f.write(data.tobytes())
+        self.count += len(codes)
+
+        meta_path = os.path.join(self.directory, META_FILE)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'dim': self.dim, 'dtype': self.dtype.name, 'count': self.count}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def encode(self, model, data_loader, device=torch.device('cpu')):
+        """Encode every batch of data_loader and append the codes"""
+        for codes, labels in encode_batches(model, data_loader, device):
+            self.append(codes, labels)
+
+    def codes(self, start=0):
+        """Read only (count - start, dim) view of the stored codes"""
+        if self.count == start:
+            return numpy.empty((0, self.dim), dtype=self.dtype)
+        return numpy.memmap(os.path.join(self.directory, CODES_FILE), dtype=self.dtype, mode='r',
+                            offset=start * self.dim * self.dtype.itemsize, shape=(self.count - start, self.dim))
+
+    def labels(self, start=0):
+        if self.count == start:
+            return numpy.empty(0, dtype=numpy.int64)
+        return numpy.memmap(os.path.join(self.directory, LABELS_FILE), dtype=numpy.int64, mode='r',
+                            offset=start * 8, shape=(self.count - start,))
+
+    def __len__(self):
+        return self.count
+
+
+class KnnAnomalyIndex:
+
+    def __init__(self, store=None, k=5, normal_number=0, block_size=4096):
+        """
+            :param store is a LatentStore whose normal rows form the reference set, or None to
+                   fill the index with add()
+            :param block_size bounds the distance block to block_size x block_size floats
+        """
+        self.store = store
+        self.k = k
+        self.normal_number = normal_number
+        self.block_size = block_size
+        self.reference = numpy.empty((0, store.dim if store is not None else 0), dtype=numpy.float32)
+        self.reference_norms = numpy.empty(0, dtype=numpy.float32)
+        self.loaded = 0
+        if store is not None:
+            self.refresh()
+
+    def refresh(self):
+        """Pick up the normal rows appended to the store since the last refresh"""
+        codes = self.store.codes(self.loaded)
+        labels = self.store.labels(self.loaded)
+        self.loaded = self.store.count
+        self.add(codes[labels == self.normal_number])
+
+    def add(self, codes):
+        """Add normal codes to the reference set"""
+        codes = numpy.asarray(codes, dtype=numpy.float32)
+        if not len(codes):
+            return
+        norms = numpy.einsum('ij,ij->i', codes, codes)
+        self.reference = codes.copy() if not len(self.reference) else numpy.concatenate((self.reference, codes))
+        self.reference_norms = numpy.concatenate((self.reference_norms, norms))
+
+    def score(self, queries, k=None):
+        """Mean euclidean distance of every query to its k nearest reference codes"""
+        k = min(k or self.k, len(self.reference))
+        if k == 0:
+            raise ValueError('the index holds no normal codes')
+        queries = numpy.asarray(queries, dtype=numpy.float32)
+        scores = numpy.empty(len(queries), dtype=numpy.float32)
+        for start in range(0, len(queries), self.block_size):
+            block = queries[start:start + self.block_size]
+            block_norms = numpy.einsum('ij,ij->i', block, block)
+            nearest = numpy.full((len(block), k), numpy.inf, dtype=numpy.float32)
+            for ref_start in range(0, len(self.reference), self.block_size):
+                reference = self.reference[ref_start:ref_start + self.block_size]
+                # |q - r|^2 = |q|^2 + |r|^2 - 2 q.r, one matrix multiply per block pair
+                distances = block_norms[:, None] + self.reference_norms[ref_start:ref_start + len(reference)] \
+                    - 2 * block.dot(reference.T)
+                candidates = numpy.concatenate((nearest, distances), axis=1)
+                nearest = numpy.partition(candidates, k - 1, axis=1)[:, :k]
+            scores[start:start + len(block)] = numpy.sqrt(numpy.maximum(nearest, 0)).mean(axis=1)
+        return scores
+
+    def score_loader(self, model, data_loader, device=torch.device('cpu')):
+        """Encode and score every sample of data_loader
+            :return scores and labels as numpy arrays
+        """
+        scores = []
+        labels = []
+        for codes, label in encode_batches(model, data_loader, device):
+            scores.append(self.score(codes))
+            labels.append(label)
+        return numpy.concatenate(scores), numpy.concatenate(labels)
@@ -0,0 +1,172 @@
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import numpy
+import torch
+import torch.utils.data
+import Helper
+from anomaly_scoring import score_model, normal_mask
+from check_point_store import CheckPointStore
+from twod_my_data_loader import MyDataLoader, img_transform
+from latent_store import encode_batches
+from ae_model import AutoEncoder
+
+'''
+    CPU inference artifacts for a trained AutoEncoder checkpoint:
+        ae_fp32.pt     traced and frozen TorchScript
+        ae_int8.pt     the same with every Linear + ReLU pair fused and every Linear layer
+                       dynamically quantized to int8, the pairs run as one linear_relu kernel
+        encoder_*.pt   optional encoder only variants that return the 30-d code
+    With --data every artifact written is loaded back and checked against the eager model:
+    validate() compares the anomaly scores and AUC of the auto encoder artifacts,
+    validate_encoder() the codes of the encoder ones. The run exits with status 1 when any
+    artifact is rejected.
+
+    The fp32 model is not fused: freezing already folds the weights into constants, and
+    torch.jit.optimize_for_inference leaves the Linear + ReLU graph unchanged on CPU.
+'''
+
+
+class Encoder(torch.nn.Module):
+    """Encoder half of an AutoEncoder, for latent extraction"""
+
+    def __init__(self, auto_encoder):
+        super(Encoder, self).__init__()
+        self.encoder = auto_encoder.encoder
+
+    def forward(self, x):
+        return self.encoder(x)
+
+
+def load_auto_encoder(checkpoint):
+    model = AutoEncoder()
+    CheckPointStore.load(checkpoint, model)
+    return model.eval()
+
+
+def fuse(model):
+    """Copy of model with every Linear followed by a ReLU inside a Sequential fused into one LinearReLU"""
+    pairs = []
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.Sequential):
+            for index in range(len(module) - 1):
+                if isinstance(module[index], torch.nn.Linear) and isinstance(module[index + 1], torch.nn.ReLU):
+                    prefix = '{}.'.format(name) if name else ''
+                    pairs.append(['{}{}'.format(prefix, index), '{}{}'.format(prefix, index + 1)])
+    return torch.quantization.fuse_modules(copy.deepcopy(model).eval(), pairs)
+
+
+def quantize(model):
+    """Copy of model with fused Linear + ReLU pairs and dynamically quantized int8 Linear layers"""
+    return torch.quantization.quantize_dynamic(fuse(model), {torch.nn.Linear, torch.ao.nn.intrinsic.LinearReLU},
+                                               dtype=torch.qint8)
+
+
+def export_torchscript(model, path=None, batch_size=128):
+    """Trace and freeze model for inference, saving it to path when given"""
+    model = model.eval()
+    example = torch.zeros(batch_size, 28 * 28)
+    with torch.no_grad():
+        script = torch.jit.freeze(torch.jit.trace(model, example))
+    if path is not None:
+        torch.jit.save(script, path)
+    return script
+
+
+def throughput(model, batch_size=128, repeat=20):
+    """Samples per second of model on a random batch"""
+    images = torch.rand(batch_size, 28 * 28) * 2 - 1
+    with torch.no_grad():
+        model(images)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(images)
+    return batch_size * repeat / (time.perf_counter() - start)
+
+
+def validate(reference, candidate, data_loader, normal_number=0, max_auc_drop=0.005):
+    """Compare a candidate's anomaly scores and AUC against the reference model
+        :param max_auc_drop is the largest AUC loss for which the candidate is accepted
+        :return dict with both AUCs, the score errors, the speedup and whether the candidate is accepted
+    """
+    reference_scores, labels = score_model(reference, data_loader)
+    candidate_scores, candidate_labels = score_model(candidate, data_loader)
+    if not (labels == candidate_labels).all():
+        raise ValueError('validation loader has to yield the same order on every pass, disable shuffle')
+    reference_scores = reference_scores['mse']
+    candidate_scores = candidate_scores['mse']
+
+    abnormal = ~normal_mask(labels, normal_number)
+    reference_auc = Helper.roc_auc(*Helper.roc_curve_from_scores(reference_scores, abnormal)[:2])
+    candidate_auc = Helper.roc_auc(*Helper.roc_curve_from_scores(candidate_scores, abnormal)[:2])
+    error = abs(candidate_scores - reference_scores)
+    return {'reference_auc': reference_auc,
+            'candidate_auc': candidate_auc,
+            'max_score_error': float(error.max()),
+            'mean_relative_score_error': float((error / abs(reference_scores).clip(min=1e-12)).mean()),
+            'speedup': throughput(candidate) / throughput(reference),
+            'accepted': reference_auc - candidate_auc <= max_auc_drop}
+
+
+def validate_encoder(reference, candidate, data_loader, max_code_error=0.05):
+    """Compare a candidate encoder's codes against the reference encoder
+        :param max_code_error is the largest code error, relative to the largest reference code, that is accepted
+        :return dict with the code errors, the speedup and whether the candidate is accepted
+    """
+    reference_codes = numpy.concatenate([codes for codes, _ in encode_batches(reference, data_loader)])
+    candidate_codes = numpy.concatenate([codes for codes, _ in encode_batches(candidate, data_loader)])
+    error = abs(candidate_codes - reference_codes)
+    relative_error = float(error.max() / max(float(abs(reference_codes).max()), 1e-12))
+    return {'max_code_error': float(error.max()),
+            'relative_code_error': relative_error,
+            'speedup': throughput(candidate) / throughput(reference),
+            'accepted': relative_error <= max_code_error}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export an AutoEncoder checkpoint for CPU inference')
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--out-dir', default='export')
+    parser.add_argument('--data', default=None, help='labelled test images to validate the artifacts on')
+    parser.add_argument('--normal-number', type=int, default=0)
+    parser.add_argument('--max-auc-drop', type=float, default=0.005)
+    parser.add_argument('--max-code-error', type=float, default=0.05)
+    parser.add_argument('--encoder', action='store_true', help='also export encoder only variants')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    model = load_auto_encoder(args.checkpoint)
+    quantized = quantize(model)
+    artifacts = {'ae_fp32.pt': export_torchscript(model), 'ae_int8.pt': export_torchscript(quantized)}
+    if args.encoder:
+        artifacts['encoder_fp32.pt'] = export_torchscript(Encoder(model))
+        artifacts['encoder_int8.pt'] = export_torchscript(Encoder(quantized))
+    for file_name, script in artifacts.items():
+        torch.jit.save(script, os.path.join(args.out_dir, file_name))
+
+    if args.data is not None:
+        data_set = MyDataLoader(path=args.data, transform=img_transform, normal_number=args.normal_number)
+        data_loader = torch.utils.data.DataLoader(dataset=data_set, batch_size=128, shuffle=False)
+        report = {}
+        for file_name in artifacts:
+            # the artifact as written, not the in-memory script it came from
+            candidate = torch.jit.load(os.path.join(args.out_dir, file_name))
+            if file_name.startswith('encoder'):
+                report[file_name] = validate_encoder(Encoder(model), candidate, data_loader,
+                                                     max_code_error=args.max_code_error)
+            else:
+                report[file_name] = validate(model, candidate, data_loader, normal_number=args.normal_number,
+                                             max_auc_drop=args.max_auc_drop)
+        with open(os.path.join(args.out_dir, 'validation.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        print(json.dumps(report, indent=2))
+        if not all(result['accepted'] for result in report.values()):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
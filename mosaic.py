@@ -0,0 +1,51 @@
+import numpy
+import torch
+
+'''
+    Tiles a batch of single channel images into one 2-D array. The output is allocated once
+    and filled through reshape/transpose views, and a tensor batch (with its reconstructions)
+    crosses from the device to the host in a single copy.
+'''
+
+
+def make_mosaic(images, reconstructions=None, n_columns=None, max_tiles=None, image_shape=(28, 28)):
+    """Lay images out on a grid, left to right and top to bottom
+        :param images is an (N, H, W), (N, 1, H, W) or flattened (N, H * W) tensor or array
+        :param reconstructions optionally pairs every image with its reconstruction right below it
+        :param n_columns is the number of tiles per row, all tiles go in one row by default
+        :param max_tiles keeps only the first max_tiles images
+        :param image_shape is (H, W) for flattened input
+        :return 2-D numpy array of shape (rows * H * (2 if paired else 1), n_columns * W)
+    """
+    if max_tiles is not None:
+        images = images[:max_tiles]
+        if reconstructions is not None:
+            reconstructions = reconstructions[:max_tiles]
+
+    if isinstance(images, torch.Tensor):
+        tiles = images.detach() if reconstructions is None else \
+            torch.stack((images.detach(), reconstructions.detach().view_as(images)), dim=1)
+        tiles = tiles.cpu().numpy()
+    else:
+        tiles = numpy.asarray(images) if reconstructions is None else \
+            numpy.stack((images, numpy.reshape(reconstructions, numpy.shape(images))), axis=1)
+
+    n = tiles.shape[0]
+    if reconstructions is None:
+        tiles = tiles[:, None]
+    # tiles is (N, P, H * W) for flattened input and (N, P, [1,] H, W) otherwise
+    width = image_shape[1] if tiles.ndim == 3 else tiles.shape[-1]
+    tiles = tiles.reshape(n, -1, width)
+    tile_height = tiles.shape[1]
+
+    if n_columns is None:
+        n_columns = max(n, 1)
+    rows = -(-n // n_columns)
+    out = numpy.zeros((rows * tile_height, n_columns * width), dtype=tiles.dtype)
+    grid = out.reshape(rows, tile_height, n_columns, width)
+    full = n // n_columns
+    grid[:full] = tiles[:full * n_columns].reshape(full, n_columns, tile_height, width).transpose(0, 2, 1, 3)
+    rest = n - full * n_columns
+    if rest:
+        grid[full, :, :rest] = tiles[full * n_columns:].transpose(1, 0, 2)
+    return out
@@ -0,0 +1,172 @@
+import math
+import time
+import functools
+import contextlib
+import torch
+
+'''
+    Wall clock timers for named training phases (data_wait, forward, backward, step, eval...).
+    Durations go into fixed log-spaced histograms, so recording a phase is a couple of
+    arithmetic operations and percentiles never need the raw samples.
+    A disabled profiler hands out one shared no-op context manager and records nothing.
+
+    profiler = PhaseProfiler()
+    for images, _ in profiler.iterate(data_loader):
+        with profiler.phase('forward'):
+            ...
+        profiler.add_samples(images.size(0))
+    recorder.log_profile(profiler, epoch)
+'''
+
+HISTOGRAM_MIN = 1e-6
+HISTOGRAM_BASE = 2 ** 0.125
+HISTOGRAM_BINS = 256
+
+_DISABLED = contextlib.nullcontext()
+
+
+class PhaseHistogram:
+    """Log-spaced histogram of durations from 1us up to about 72 minutes (2 ** 32 us), +-4.4% per bin"""
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BINS
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        if seconds <= HISTOGRAM_MIN:
+            index = 0
+        else:
+            index = min(int(math.log(seconds / HISTOGRAM_MIN, HISTOGRAM_BASE)), HISTOGRAM_BINS - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q):
+        """Approximate q-th percentile (0-100) in seconds, the geometric middle of its bin"""
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return HISTOGRAM_MIN * HISTOGRAM_BASE ** (index + 0.5)
+        return HISTOGRAM_MIN * HISTOGRAM_BASE ** HISTOGRAM_BINS
+
+
+class _Phase:
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if self.profiler.cuda_sync:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler.cuda_sync:
+            torch.cuda.synchronize()
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class PhaseProfiler:
+
+    def __init__(self, enabled=True, cuda_sync=False):
+        """
+            :param enabled False turns every call into a no-op
+            :param cuda_sync synchronizes the GPU around each phase so kernels are charged to it,
+                   which serializes the pipeline and is off by default
+        """
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.histograms = {}
+        self.samples = 0
+        self.started = time.perf_counter()
+        self.torch_profiler = None
+        self.trace_steps = 0
+
+    def phase(self, name):
+        if not self.enabled:
+            return _DISABLED
+        return _Phase(self, name)
+
+    def timed(self, name):
+        """Decorator form of phase()"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def iterate(self, iterable, name='data_wait'):
+        """Yield from iterable, timing every wait for the next item as the phase name"""
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - start)
+            yield item
+
+    def add(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = PhaseHistogram()
+        histogram.add(seconds)
+
+    def add_samples(self, count):
+        if self.enabled:
+            self.samples += count
+
+    def trace(self, directory, wait=10, warmup=2, active=5):
+        """Capture a torch.profiler trace of steps [wait + warmup, wait + warmup + active)
+            :param directory receives the trace in TensorBoard's format
+            call step() once per training step to advance the window
+        """
+        if not self.enabled:
+            return
+        self.torch_profiler = torch.profiler.profile(
+            schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(directory),
+            record_shapes=True)
+        self.trace_steps = wait + warmup + active
+        self.torch_profiler.start()
+
+    def step(self):
+        if self.torch_profiler is None:
+            return
+        self.torch_profiler.step()
+        self.trace_steps -= 1
+        if self.trace_steps < 0:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+
+    def summary(self):
+        """Per phase p50/p95/mean in milliseconds and the sample throughput since the last reset"""
+        result = {}
+        for name, histogram in self.histograms.items():
+            result[name] = {'p50_ms': histogram.percentile(50) * 1000,
+                            'p95_ms': histogram.percentile(95) * 1000,
+                            'mean_ms': histogram.total / histogram.count * 1000,
+                            'count': histogram.count}
+        elapsed = time.perf_counter() - self.started
+        samples_per_sec = self.samples / elapsed if elapsed > 0 else 0.0
+        return result, samples_per_sec
+
+    def reset(self):
+        self.histograms = {}
+        self.samples = 0
+        self.started = time.perf_counter()
@@ -0,0 +1,311 @@
+import io
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+import http.server
+import torch
+from PIL import Image
+from anomaly_scoring import reconstruction_error
+from check_point_store import CheckPointStore
+from phase_profiler import PhaseProfiler
+from twod_my_data_loader import img_transform
+from ae_model import AutoEncoder
+
+'''
+    Long lived scorer: the checkpoint is loaded once and concurrent requests are merged into
+    micro-batches of up to max_batch images, waiting at most max_latency seconds after the
+    first one arrives.
+
+    python scoring_service.py --checkpoint AE_MNIST/CheckPointStore --threshold 0.2 --port 8080
+        POST /score   body is one image file, answers {"score": ..., "anomaly": ...}
+        GET /metrics  request, batch and latency counters
+    --unix-socket serves the same interface on a Unix socket, --directory scores a directory
+    and --stdin scores the image paths read from standard input, one per line.
+'''
+
+IMAGE_SHAPE = (1, 28, 28)
+
+
+class PendingScore:
+
+    def __init__(self, image):
+        self.image = image
+        self.arrived = time.perf_counter()
+        self.done = threading.Event()
+        self.score = None
+        self.error = None
+
+    def result(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError('image was not scored within {}s'.format(timeout))
+        if self.error is not None:
+            raise self.error
+        return self.score
+
+
+class MicroBatcher:
+
+    def __init__(self, model, device=torch.device('cpu'), max_batch=64, max_latency=0.005, reduction='mse'):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.reduction = reduction
+        self.queue = queue.Queue()
+        self.profiler = PhaseProfiler()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.worker = threading.Thread(target=self._run, name='MicroBatcher', daemon=True)
+        self.worker.start()
+
+    def submit(self, image):
+        """Queue one transformed image tensor, returns a PendingScore"""
+        pending = PendingScore(image)
+        self.queue.put(pending)
+        return pending
+
+    def metrics(self):
+        with self.lock:
+            phases, requests_per_sec = self.profiler.summary()
+            return {'requests': self.requests,
+                    'batches': self.batches,
+                    'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+                    'requests_per_sec': requests_per_sec,
+                    'latency_ms': phases.get('latency', {}),
+                    'batch_ms': phases.get('batch', {})}
+
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+
+    # Private Functionality
+
+    def _run(self):
+        running = True
+        while running:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = first.arrived + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._score(batch)
+
+    def _score(self, batch):
+        start = time.perf_counter()
+        try:
+            images = torch.stack([pending.image for pending in batch])
+            images = images.view(images.size(0), -1).to(self.device)
+            with torch.no_grad():
+                _, decoded_data = self.model(images)
+                scores = reconstruction_error(images, decoded_data, self.reduction).cpu().tolist()
+        except Exception as error:
+            for pending in batch:
+                pending.error = error
+                pending.done.set()
+            return
+
+        finished = time.perf_counter()
+        for pending, score in zip(batch, scores):
+            pending.score = score
+            pending.done.set()
+        with self.lock:
+            self.requests += len(batch)
+            self.batches += 1
+            self.profiler.add_samples(len(batch))
+            self.profiler.add('batch', finished - start)
+            for pending in batch:
+                self.profiler.add('latency', finished - pending.arrived)
+
+
+class ScoringService:
+
+    def __init__(self, checkpoint, threshold, device=torch.device('cpu'),
+                 max_batch=64, max_latency=0.005, reduction='mse'):
+        """
+            :param checkpoint is a checkpoint file, or a CheckPointStore directory to take the best
+                   (or else the latest) checkpoint from
+            :param threshold flags an image as anomalous when its score is above it
+        """
+        if os.path.isdir(checkpoint):
+            store = CheckPointStore(checkpoint)
+            checkpoint = store.best() or store.latest()
+            if checkpoint is None:
+                raise FileNotFoundError('no checkpoint in {}'.format(store.directory))
+        self.checkpoint = checkpoint
+        self.threshold = threshold
+        model = AutoEncoder().to(device)
+        CheckPointStore.load(checkpoint, model, map_location=device)
+        model.eval()
+        self.batcher = MicroBatcher(model, device, max_batch=max_batch, max_latency=max_latency, reduction=reduction)
+
+    def submit(self, image):
+        """Queue a PIL image or image file contents, returns a PendingScore"""
+        if isinstance(image, (bytes, bytearray)):
+            image = Image.open(io.BytesIO(image))
+        image = img_transform(image.convert('L'))
+        # rejected here, a wrong sized image in the batch would fail every request stacked with it
+        if tuple(image.shape) != IMAGE_SHAPE:
+            raise ValueError('expected a {}x{} image, got {}x{}'.format(IMAGE_SHAPE[2], IMAGE_SHAPE[1],
+                                                                      image.shape[2], image.shape[1]))
+        return self.batcher.submit(image)
+
+    def result(self, pending, timeout=None):
+        score = pending.result(timeout)
+        return {'score': score, 'anomaly': score > self.threshold}
+
+    def score(self, image, timeout=None):
+        return self.result(self.submit(image), timeout)
+
+    def score_paths(self, paths):
+        """Score image files as paths arrives, yielding (path, result) in order
+            :param paths is any iterable, it is consumed lazily with at most max_batch images in flight
+        """
+        in_flight = queue.Queue(maxsize=self.batcher.max_batch)
+
+        def produce():
+            try:
+                for path in paths:
+                    try:
+                        in_flight.put((path, self.submit(Image.open(path))))
+                    except Exception as error:
+                        in_flight.put((path, error))
+            finally:
+                in_flight.put(None)
+
+        threading.Thread(target=produce, name='PathReader', daemon=True).start()
+        while True:
+            item = in_flight.get()
+            if item is None:
+                return
+            path, pending = item
+            if isinstance(pending, Exception):
+                yield path, {'error': str(pending)}
+            else:
+                yield path, self.result(pending)
+
+    def metrics(self):
+        return self.batcher.metrics()
+
+    def close(self):
+        self.batcher.close()
+
+
+class ScoringHandler(http.server.BaseHTTPRequestHandler):
+
+    service = None
+
+    def do_POST(self):
+        if self.path != '/score':
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            self.send_json(200, self.service.score(self.rfile.read(length)))
+        except Exception as error:
+            self.send_json(400, {'error': str(error)})
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        self.send_json(200, self.service.metrics())
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket peers have no (host, port) address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TCPHTTPServer(http.server.ThreadingHTTPServer):
+    # the default backlog of 5 resets connections under concurrent load
+    request_queue_size = 128
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(service, host='127.0.0.1', port=8080, unix_socket=None):
+    handler = type('BoundScoringHandler', (ScoringHandler,), {'service': service})
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return UnixHTTPServer(unix_socket, handler)
+    return TCPHTTPServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve AutoEncoder anomaly scores')
+    parser.add_argument('--checkpoint', required=True)
+    parser.add_argument('--threshold', type=float, required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix-socket', default=None)
+    parser.add_argument('--directory', default=None, help='score every image in this directory and exit')
+    parser.add_argument('--stdin', action='store_true', help='score image paths read from stdin and exit')
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-latency-ms', type=float, default=5.0)
+    parser.add_argument('--reduction', default='mse')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    service = ScoringService(args.checkpoint, args.threshold, max_batch=args.max_batch,
+                             max_latency=args.max_latency_ms / 1000, reduction=args.reduction)
+    print('>> {} loaded'.format(service.checkpoint), file=sys.stderr)
+
+    if args.directory is not None or args.stdin:
+        if args.directory is not None:
+            paths = (os.path.join(args.directory, name) for name in sorted(os.listdir(args.directory)))
+        else:
+            paths = (line.strip() for line in sys.stdin if line.strip())
+        for path, result in service.score_paths(paths):
+            if 'error' in result:
+                print('{}\terror\t{}'.format(path, result['error']), flush=True)
+            else:
+                print('{}\t{:.6f}\t{}'.format(path, result['score'], int(result['anomaly'])), flush=True)
+        print(json.dumps(service.metrics()), file=sys.stderr)
+        service.close()
+        return
+
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    print('>> listening on {}'.format(args.unix_socket or '{}:{}'.format(args.host, args.port)), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2 @@
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'slow: spawns processes or trains, deselect with -m "not slow"')
@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import distributed_train
+
+
+@pytest.mark.slow
+def test_distributed_matches_single_process():
+    tolerance = 1e-5
+    parameter_difference, score_difference = distributed_train.verify(2, tolerance=tolerance)
+    assert parameter_difference <= tolerance
+    assert score_difference <= tolerance
@@ -0,0 +1,63 @@
+import os
+import sys
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Recorder import Recorder, MetricAccumulator
+
+
+def test_accumulates_fp16_in_float32():
+    accumulator = MetricAccumulator()
+    for _ in range(1000):
+        accumulator.update('loss', torch.tensor(0.1, dtype=torch.float16))
+    summary = accumulator.summary()['loss']
+    # an fp16 running sum is rounded to 0.0625 steps near 100, so the mean would drift
+    assert summary['mean'] == pytest.approx(float(torch.tensor(0.1, dtype=torch.float16)), rel=1e-5)
+    assert summary['count'] == 1000
+    assert accumulator.summary() == {}
+
+
+def test_mixes_tensors_and_numbers():
+    accumulator = MetricAccumulator()
+    for step in range(4):
+        accumulator.update('loss', torch.tensor(float(step)))
+        accumulator.update('lr', 0.001)
+        accumulator.update('weight', torch.tensor(2.0, dtype=torch.float64))
+    summary = accumulator.summary()
+    assert summary['loss'] == {'mean': 1.5, 'min': 0.0, 'max': 3.0, 'count': 4}
+    assert summary['lr']['mean'] == pytest.approx(0.001)
+    assert summary['weight']['max'] == 2.0
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs a CUDA device')
+def test_numbers_follow_the_device_loss():
+    accumulator = MetricAccumulator()
+    for _ in range(3):
+        accumulator.update('loss', torch.tensor(0.5, device='cuda', dtype=torch.float16))
+        accumulator.update('lr', 0.001)
+    assert accumulator.metrics['lr'][0].device.type == 'cuda'
+    summary = accumulator.summary()
+    assert summary['loss']['mean'] == pytest.approx(0.5)
+    assert summary['lr']['mean'] == pytest.approx(0.001)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs a CUDA device')
+def test_metrics_on_different_devices():
+    accumulator = MetricAccumulator()
+    accumulator.update('lr', 0.001)
+    accumulator.update('loss', torch.tensor(0.5, device='cuda'))
+    summary = accumulator.summary()
+    assert summary['lr']['mean'] == pytest.approx(0.001)
+    assert summary['loss']['mean'] == pytest.approx(0.5)
+
+
+def test_check_points_keep_the_highest_score(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    recorder = Recorder('test', 'TEST', interactive=False, keep_last=1, keep_best=1, higher_is_better=True)
+    model = torch.nn.Linear(2, 2)
+    for epoch, auc in enumerate([0.7, 0.9, 0.6, 0.8]):
+        recorder.save_check_point(model, epoch, score=auc)
+    recorder.close()
+    assert os.path.basename(recorder.check_points.best()) == 'final_epoch_1.pt'
+    assert sorted(os.listdir(recorder.check_point_store)) == ['final_epoch_1.pt', 'final_epoch_3.pt', 'index.json']
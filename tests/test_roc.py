@@ -0,0 +1,66 @@
+import os
+import sys
+import numpy
+import pytest
+from sklearn import metrics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import Helper
+
+
+def random_scores(size=2000, seed=0, ties=False):
+    rng = numpy.random.RandomState(seed)
+    positive = rng.rand(size) < 0.2
+    scores = rng.rand(size) + 0.5 * positive
+    if ties:
+        scores = numpy.round(scores, 1)
+    return scores, positive
+
+
+@pytest.mark.parametrize('fp_list, tp_list', [
+    ([0, 0.5, 1], [0, 0.8, 1]),
+    ([1, 0.5, 0], [1, 0.8, 0]),
+    ([0, 0, 0.5, 1, 1], [0, 0.3, 0.8, 0.9, 1]),
+    ([1, 1, 0.5, 0, 0], [1, 0.9, 0.8, 0.3, 0]),
+])
+def test_roc_auc_matches_sklearn(fp_list, tp_list):
+    assert Helper.roc_auc(fp_list, tp_list) == pytest.approx(metrics.auc(fp_list, tp_list))
+
+
+def test_roc_auc_rejects_unsorted():
+    with pytest.raises(ValueError):
+        Helper.roc_auc([0, 1, 0.5], [0, 1, 0.8])
+    with pytest.raises(ValueError):
+        Helper.roc_auc([0], [0])
+
+
+@pytest.mark.parametrize('ties', [False, True])
+def test_roc_curve_matches_sklearn(ties):
+    scores, positive = random_scores(ties=ties)
+    fpr, tpr, _ = Helper.roc_curve_from_scores(scores, positive)
+    expected_fpr, expected_tpr, _ = metrics.roc_curve(positive, scores, drop_intermediate=False)
+    numpy.testing.assert_allclose(fpr, expected_fpr)
+    numpy.testing.assert_allclose(tpr, expected_tpr)
+    assert Helper.roc_auc(fpr, tpr) == pytest.approx(metrics.roc_auc_score(positive, scores))
+
+
+def test_weighted_roc_matches_sklearn():
+    scores, positive = random_scores()
+    weights = numpy.random.RandomState(1).rand(len(scores))
+    fpr, tpr, _ = Helper.roc_curve_from_scores(scores, positive, weights)
+    assert Helper.roc_auc(fpr, tpr) == pytest.approx(metrics.roc_auc_score(positive, scores, sample_weight=weights))
+
+
+def test_average_precision_matches_sklearn():
+    scores, positive = random_scores(ties=True)
+    average_precision = Helper.pr_curve_from_scores(scores, positive)[3]
+    assert average_precision == pytest.approx(metrics.average_precision_score(positive, scores))
+
+
+def test_streaming_roc_merges_shards():
+    scores, positive = random_scores()
+    merged = Helper.StreamingRoc(0, 1.5)
+    for start in range(0, len(scores), 500):
+        shard = Helper.StreamingRoc(0, 1.5).update(scores[start:start + 500], positive[start:start + 500])
+        merged.merge(shard)
+    assert merged.auc() == pytest.approx(metrics.roc_auc_score(positive, scores), abs=1e-3)
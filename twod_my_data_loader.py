@@ -1,14 +1,37 @@
 import os
+import json
 import random
+import numpy
 import torch.utils.data
+import torchvision
 
 from PIL import Image
 
+'''
+    With cache_dir set, the first pass decodes every image of the directory into
+    one contiguous uint8 array (images.npy) plus a label array (labels.npy).
+    manifest.json records the file names, sizes and mtimes the cache was built
+    from; the cache is rebuilt only when the directory no longer matches it.
+
+    Indexing with a list of indices returns a whole (images, labels) batch; use
+    batch_data_loader() to drive the dataset with one index list per batch.
+'''
+
+CACHE_IMAGES = 'images.npy'
+CACHE_LABELS = 'labels.npy'
+CACHE_MANIFEST = 'manifest.json'
+
+# the transform the AutoEncoder is trained with, images scaled to [-1, 1]
+img_transform = torchvision.transforms.Compose([
+    torchvision.transforms.ToTensor(),
+    torchvision.transforms.Normalize((0.5,), (0.5,))
+])
+
 
 class MyDataLoader(torch.utils.data.Dataset):
 
     # constructor of the class
-    def __init__(self, path, transform, normal_number=0, shuffle=False):
+    def __init__(self, path, transform, normal_number=0, shuffle=False, cache_dir=None):
         self.current_normal_number = normal_number
         self.transform = transform
         images = [os.path.join(path, img) for img in os.listdir(path)]
@@ -16,13 +39,164 @@ class MyDataLoader(torch.utils.data.Dataset):
             random.shuffle(images)
         self.images = images
 
+        self.cache_dir = cache_dir
+        self.rows = None
+        self.labels = None
+        self._cache = None
+        if cache_dir is not None:
+            row_of = MyDataLoader.build_cache(path, cache_dir)
+            self.rows = numpy.array([row_of[os.path.basename(img)] for img in images], dtype=numpy.int64)
+            self.labels = numpy.load(os.path.join(cache_dir, CACHE_LABELS))[self.rows]
+        self.batch_normalize = MyDataLoader.vectorized_normalize(transform)
+
     def __getitem__(self, index):
-        image_path = self.images[index]
-        label = int(image_path.split('/')[-1].split('_')[0])
+        if isinstance(index, (list, tuple, numpy.ndarray, torch.Tensor)):
+            return self.get_batch(index)
+
+        if self.cache_dir is None:
+            image_path = self.images[index]
+            label = int(image_path.split('/')[-1].split('_')[0])
+            data = Image.open(image_path)
+        else:
+            label = int(self.labels[index])
+            if self.batch_normalize is not None:
+                # straight from the memmap, no PIL round trip and no per-sample transform
+                return self.to_tensor(self.cache[self.rows[index:index + 1]])[0], label
+            data = Image.fromarray(self.cache[self.rows[index]])
 
-        data = Image.open(image_path)
         data = self.transform(data)
         return data, label
 
     def __len__(self):
         return len(self.images)
+
+    def get_batch(self, indices):
+        """Return the samples at indices as one (images, labels) pair of tensors
+            :param indices is a sequence of dataset indices
+        """
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        if self.cache_dir is None or self.batch_normalize is None:
+            samples = [self[int(index)] for index in indices]
+            return torch.stack([data for data, _ in samples]), torch.tensor([label for _, label in samples])
+
+        return self.to_tensor(self.cache[self.rows[indices]]), torch.from_numpy(self.labels[indices])
+
+    def to_tensor(self, images):
+        """Vectorized ToTensor and Normalize of an (N, H, W[, C]) uint8 array into (N, C, H, W) floats"""
+        data = torch.from_numpy(images)
+        if data.dim() == 3:
+            data = data.unsqueeze(1)
+        else:
+            data = data.permute(0, 3, 1, 2).contiguous()
+        data = data.float().div_(255)
+        mean, std = self.batch_normalize
+        if mean is not None:
+            channels = data.size(1)
+            mean = torch.tensor(mean[:channels], dtype=data.dtype).view(1, -1, 1, 1)
+            std = torch.tensor(std[:channels], dtype=data.dtype).view(1, -1, 1, 1)
+            data.sub_(mean).div_(std)
+        return data
+
+    @property
+    def cache(self):
+        # opened lazily so DataLoader workers map the file instead of receiving a pickled copy
+        if self._cache is None:
+            self._cache = numpy.load(os.path.join(self.cache_dir, CACHE_IMAGES), mmap_mode='r')
+        return self._cache
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        return state
+
+    @staticmethod
+    def build_cache(path, cache_dir):
+        """Decode the images of path into cache_dir unless the cache is up to date
+            :param path is the image directory
+            :param cache_dir is where images.npy, labels.npy and manifest.json live
+            :return dict mapping file name to its row in the cache
+        """
+        names = sorted(os.listdir(path))
+        files = []
+        for name in names:
+            stat = os.stat(os.path.join(path, name))
+            files.append([name, stat.st_size, stat.st_mtime_ns])
+        manifest = {'path': os.path.abspath(path), 'files': files}
+
+        manifest_path = os.path.join(cache_dir, CACHE_MANIFEST)
+        if not MyDataLoader.cache_is_valid(cache_dir, manifest):
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            if not names:
+                # an empty directory gives an empty dataset, like the uncached path
+                numpy.save(os.path.join(cache_dir, CACHE_IMAGES), numpy.empty((0, 0, 0), dtype=numpy.uint8))
+                numpy.save(os.path.join(cache_dir, CACHE_LABELS), numpy.empty(0, dtype=numpy.int64))
+                with open(manifest_path + '.tmp', 'w') as f:
+                    json.dump(manifest, f)
+                os.replace(manifest_path + '.tmp', manifest_path)
+                return {}
+            first = numpy.asarray(Image.open(os.path.join(path, names[0])))
+            images = numpy.lib.format.open_memmap(os.path.join(cache_dir, CACHE_IMAGES + '.tmp'), mode='w+',
+                                                  dtype=numpy.uint8, shape=(len(names),) + first.shape)
+            labels = numpy.empty(len(names), dtype=numpy.int64)
+            for row, name in enumerate(names):
+                data = numpy.asarray(Image.open(os.path.join(path, name)))
+                if data.shape != first.shape:
+                    raise ValueError('{} has shape {}, expected {}'.format(name, data.shape, first.shape))
+                images[row] = data
+                labels[row] = int(name.split('_')[0])
+            images.flush()
+            del images
+            numpy.save(os.path.join(cache_dir, CACHE_LABELS + '.tmp.npy'), labels)
+            os.replace(os.path.join(cache_dir, CACHE_IMAGES + '.tmp'), os.path.join(cache_dir, CACHE_IMAGES))
+            os.replace(os.path.join(cache_dir, CACHE_LABELS + '.tmp.npy'), os.path.join(cache_dir, CACHE_LABELS))
+            # manifest goes last, a crash before this point just means a rebuild next time
+            with open(manifest_path + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.replace(manifest_path + '.tmp', manifest_path)
+
+        return {name: row for row, name in enumerate(names)}
+
+    @staticmethod
+    def cache_is_valid(cache_dir, manifest):
+        manifest_path = os.path.join(cache_dir, CACHE_MANIFEST)
+        for name in (CACHE_MANIFEST, CACHE_IMAGES, CACHE_LABELS):
+            if not os.path.exists(os.path.join(cache_dir, name)):
+                return False
+        with open(manifest_path) as f:
+            return json.load(f) == manifest
+
+    @staticmethod
+    def vectorized_normalize(transform):
+        """Return (mean, std) when transform is ToTensor optionally followed by Normalize,
+            (None, None) for ToTensor alone and None when the batch has to go through transform
+        """
+        transforms = transform.transforms if isinstance(transform, torchvision.transforms.Compose) else [transform]
+        if not transforms or not isinstance(transforms[0], torchvision.transforms.ToTensor):
+            return None
+        if len(transforms) == 1:
+            return None, None
+        if len(transforms) == 2 and isinstance(transforms[1], torchvision.transforms.Normalize):
+            normalize = transforms[1]
+            return tuple(numpy.atleast_1d(normalize.mean)), tuple(numpy.atleast_1d(normalize.std))
+        return None
+
+
+def batch_data_loader(data_set, batch_size, shuffle=False, drop_last=False,
+                      num_workers=0, persistent_workers=False, sampler=None):
+    """DataLoader that fetches one whole batch per dataset access
+        :param data_set is a MyDataLoader, ideally with cache_dir set
+        :param persistent_workers keeps worker processes alive across epochs when num_workers > 0
+        :param sampler replaces the random/sequential sampler, e.g. a DistributedSampler
+    """
+    if sampler is None and shuffle:
+        sampler = torch.utils.data.RandomSampler(data_set)
+    elif sampler is None:
+        sampler = torch.utils.data.SequentialSampler(data_set)
+    batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+    # batch_size=None disables per-sample collation, each index list goes straight to get_batch
+    return torch.utils.data.DataLoader(dataset=data_set,
+                                       sampler=batch_sampler,
+                                       batch_size=None,
+                                       num_workers=num_workers,
+                                       persistent_workers=persistent_workers and num_workers > 0)